@@ -3,34 +3,83 @@ Inits the summary bot. It starts a Reddit instance using PRAW, gets the latest p
 and filters those who have already been processed.
 """
 import argparse
+import asyncio
+import codecs
+import functools
+import hashlib
 import logging
+import multiprocessing
 import os
+import re
+import shelve
+import sqlite3
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
 from logging.handlers import RotatingFileHandler
+from urllib.parse import urlsplit
 
 from pythorhead import Lemmy
 
 import requests
 import tldextract
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from pythorhead.types import SortType, ListingType
 
 import scraper
 import summary
 from utils import PostUtils
 
+log = logging.getLogger(__name__)
+
 # We don't reply to posts which have a very small or very high reduction.
 MINIMUM_REDUCTION_THRESHOLD = 50
 MAXIMUM_REDUCTION_THRESHOLD = 96
 
 # File locations
+POSTS_DB = "./assets/processed_posts.db"
 POSTS_LOG = "./assets/processed_posts.txt"
 BLOCKLIST_FILE = "./assets/blocklist.txt"
+SUMMARY_CACHE_FILE = "./assets/summary_cache"
+
+# How long (in seconds) we keep a scraped and summarized article around.
+SUMMARY_CACHE_EXPIRATION = 7 * 86400
 
 # Templates.
 TEMPLATE = open("./templates/en.txt", "r", encoding="utf-8").read()
 
 HEADERS = {"User-Agent": "Summarizer v2.0"}
 
+# The number of articles we download at the same time and how many posts we schedule per batch.
+FETCH_CONCURRENCY = 20
+FETCH_CHUNK_SIZE = 100
+
+# We don't download the body of responses with these content types.
+BLOCKED_CONTENT_TYPES = ('image/', 'video/', 'audio/', 'application/pdf', 'application/octet-stream')
+
+# Articles bigger than this (in bytes) are not downloaded.
+MAX_ARTICLE_SIZE = 5 * 1024 * 1024
+
+# The size of the chunks we read the article body with.
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# How many bytes from the start of the document we look at to find its declared charset.
+CHARSET_SNIFF_SIZE = 4096
+ISO_8859_1_PATTERN = re.compile(rb"iso-8859-1", re.IGNORECASE)
+
+# A shared session so keep-alive connections are reused across posts of the same domain.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+# Retry-After is ignored, a large value would stall a download thread and hold a fetch slot.
+HTTP_ADAPTER = HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=False))
+SESSION.mount("https://", HTTP_ADAPTER)
+SESSION.mount("http://", HTTP_ADAPTER)
+
 
 def load_blocklist():
     """Reads the processed posts log file and creates it if it doesn't exist.
@@ -46,104 +95,382 @@ def load_blocklist():
         return log_file.read().splitlines()
 
 
-def load_log():
-    """Reads the processed posts log file and creates it if it doesn't exist.
+BLOCKLIST = frozenset(load_blocklist())
+
+# We use the public suffix snapshot bundled with tldextract, this way it never
+# downloads the list or touches its disk cache.
+TLD_EXTRACT = tldextract.TLDExtract(cache_dir=None, suffix_list_urls=())
+
+
+@functools.lru_cache(maxsize=4096)
+def extract_domain(hostname):
+    """Gets the registered domain of the given hostname.
+
+    Parameters
+    ----------
+    hostname : str
+        The hostname of an article url.
 
     Returns
     -------
-    list
-        A list of Reddit posts ids.
+    str
+        The domain and its suffix, e.g. example.com
 
     """
 
-    try:
+    ext = TLD_EXTRACT(hostname)
+    return "{}.{}".format(ext.domain, ext.suffix)
+
+
+def open_log():
+    """Opens the processed posts database and creates it if it doesn't exist.
+
+    The first time, the ids from the old plain text log are imported into it.
+
+    Returns
+    -------
+    sqlite3.Connection
+        The connection to the processed posts database.
+
+    """
+
+    conn = sqlite3.connect(POSTS_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS seen(id TEXT PRIMARY KEY)")
+
+    if os.path.exists(POSTS_LOG) and conn.execute("SELECT 1 FROM seen LIMIT 1").fetchone() is None:
         with open(POSTS_LOG, "r", encoding="utf-8") as log_file:
-            return log_file.read().splitlines()
+            conn.executemany("INSERT OR IGNORE INTO seen VALUES (?)",
+                             ((post_id,) for post_id in log_file.read().splitlines() if post_id))
+
+    conn.commit()
+    return conn
+
+
+def load_log(conn):
+    """Reads the ids of the processed posts.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        The processed posts database.
+
+    Returns
+    -------
+    set
+        A set of Lemmy posts ids.
+
+    """
+
+    return {row[0] for row in conn.execute("SELECT id FROM seen")}
+
+
+def update_log(conn, post_ids, processed_posts):
+    """Adds a batch of post ids to the processed posts database, the caller commits.
+
+    Parameters
+    ----------
+    conn : sqlite3.Connection
+        The processed posts database.
+
+    post_ids : list
+        The Lemmy post ids to add.
+
+    processed_posts : set
+        The in-memory copy of the log, kept in sync so we don't have to query the database again.
+
+    """
+
+    conn.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((post_id,) for post_id in post_ids))
+    processed_posts.update(post_ids)
+
+
+def fetch_html(url):
+    """Downloads the given url and returns its decoded HTML source.
+
+    Parameters
+    ----------
+    url : str
+        The article url.
+
+    Returns
+    -------
+    str
+        The HTML source or None when the url points to media or a document.
+
+    """
+
+    # We stream the response so media bodies are never downloaded, we only look at the headers.
+    with SESSION.get(url, timeout=10, stream=True) as response:
+        content_type = response.headers.get('content-type', '')
+        mime_type = content_type.split(';')[0].strip().lower()
+        if mime_type.startswith(BLOCKED_CONTENT_TYPES):
+            log.info("BLOCK Content-Type: %s", mime_type)
+            return None
+
+        if int(response.headers.get('content-length') or 0) > MAX_ARTICLE_SIZE:
+            raise ValueError(f"Article is larger than {MAX_ARTICLE_SIZE} bytes")
+
+        # The Content-Length header can be missing or wrong, we also stop reading once we go over the limit.
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_ARTICLE_SIZE:
+                raise ValueError(f"Article is larger than {MAX_ARTICLE_SIZE} bytes")
+            chunks.append(chunk)
+        raw = b"".join(chunks)
+
+        # requests already picks up the charset from the Content-Type header. When it is missing
+        # we default to utf-8, unless ISO-8859-1 is declared near the top of the HTML document.
+        if 'charset' in content_type.lower():
+            encoding = response.encoding
+        elif ISO_8859_1_PATTERN.search(raw, 0, CHARSET_SNIFF_SIZE):
+            encoding = "iso-8859-1"
+        else:
+            encoding = "utf-8"
+
+        # Servers sometimes declare charsets Python doesn't know (utf8mb4, typos...), we fall back to utf-8.
+        try:
+            codecs.lookup(encoding or "utf-8")
+        except LookupError:
+            log.debug("Unknown charset %s for %s, decoding as utf-8", encoding, url)
+            encoding = "utf-8"
+
+        return raw.decode(encoding or "utf-8", errors="replace")
+
+
+def cache_key(text):
+    """Returns the SHA-256 hex digest of the given text, used as a summary cache key."""
+
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_cached_summary(summary_cache, key):
+    """Gets a previously scraped and summarized article.
+
+    Parameters
+    ----------
+    summary_cache : shelve.Shelf
+        The summary cache.
+
+    key : str
+        The hash of the article url or HTML source.
+
+    Returns
+    -------
+    tuple
+        The article title, date and summary dict or None when it isn't cached or has expired.
+
+    """
+
+    entry = summary_cache.get(key)
+    if entry is None:
+        return None
+
+    cached_at, article = entry
+    if time.time() - cached_at > SUMMARY_CACHE_EXPIRATION:
+        del summary_cache[key]
+        return None
+
+    return article
+
+
+def expire_summary_cache(summary_cache):
+    """Removes the expired entries from the summary cache.
+
+    Most keys, like the HTML hashes, are never read again, so they would never expire on lookup.
+
+    Parameters
+    ----------
+    summary_cache : shelve.Shelf
+        The summary cache.
+
+    """
 
-    except FileNotFoundError:
-        with open(POSTS_LOG, "a", encoding="utf-8") as log_file:
-            return []
+    now = time.time()
+    expired = [key for key, (cached_at, _) in summary_cache.items() if now - cached_at > SUMMARY_CACHE_EXPIRATION]
+    for key in expired:
+        del summary_cache[key]
 
+    if expired:
+        log.info("EXPIRED %d cached summaries", len(expired))
 
-def update_log(post_id):
-    """Updates the processed posts log with the given post id.
+
+def is_eligible(post, processed_posts):
+    """Checks if the post links to an article we haven't processed yet and whose domain isn't blocked.
+
+    Parameters
+    ----------
+    post : dict
+        A Lemmy post.
+
+    processed_posts : set
+        The ids of the posts we already processed.
+
+    Returns
+    -------
+    bool
+        True when the article of the post has to be summarized.
+
+    """
+
+    if not post['url'] or str(post['id']) in processed_posts:
+        return False
+
+    clean_url = post['url'].replace("amp.", "")
+    try:
+        hostname = urlsplit(clean_url).hostname
+    except ValueError:
+        log.warning("MALFORMED url: %s on %s", clean_url, post['ap_id'])
+        return False
+
+    url_domain = extract_domain(hostname or "")
+    if url_domain in BLOCKLIST:
+        log.debug("BLOCKLIST domain: %s from %s on %s", url_domain, clean_url, post['ap_id'])
+        return False
+
+    return True
+
+
+async def process_post(post, semaphore, summary_cache, pool):
+    """Downloads, scrapes and summarizes the article of a single post.
 
     Parameters
     ----------
-    post_id : str
-        A Reddit post id.
+    post : dict
+        A Lemmy post.
+
+    semaphore : asyncio.Semaphore
+        Bounds the number of articles being fetched at the same time.
+
+    summary_cache : shelve.Shelf
+        Already summarized articles, keyed by the hash of their url and of their HTML source.
+
+    pool : concurrent.futures.ProcessPoolExecutor
+        The worker processes that scrape and summarize the articles.
+
+    Returns
+    -------
+    str
+        The post id, to be logged as processed.
 
     """
 
-    with open(POSTS_LOG, "a", encoding="utf-8") as log_file:
-        log_file.write("{}\n".format(post_id))
+    loop = asyncio.get_running_loop()
+    post_id = str(post['id'])
+    clean_url = post['url'].replace("amp.", "")
+    url_domain = extract_domain(urlsplit(clean_url).hostname or "")
+    log.info("SUMMARIZE domain: %s from %s on %s", url_domain, clean_url, post['ap_id'])
+
+    try:
+        # Cross-posted articles share the same url, we don't download or summarize them twice.
+        url_key = cache_key(clean_url)
+        article = get_cached_summary(summary_cache, url_key)
+
+        if article is None:
+            async with semaphore:
+                html_source = await loop.run_in_executor(None, fetch_html, clean_url)
+
+            if html_source is None:
+                return post_id
+
+            # Mirrors of the same article under different urls produce the same HTML.
+            html_key = cache_key(html_source)
+            article = get_cached_summary(summary_cache, html_key)
+
+            if article is None:
+                # Scraping and summarizing are CPU bound, we run them in other processes
+                # so they use all cores and don't hold the GIL while we download articles.
+                article_title, article_date, article_body = await loop.run_in_executor(
+                    pool, scraper.scrape_html, html_source)
+
+                summary_dict = await loop.run_in_executor(pool, summary.get_summary, article_body)
+                article = (article_title, article_date, summary_dict)
+                summary_cache[html_key] = (time.time(), article)
+
+            summary_cache[url_key] = (time.time(), article)
+        else:
+            log.info("CACHED summary for %s", clean_url)
+
+        article_title, article_date, summary_dict = article
+    except BrokenProcessPool:
+        # The post isn't at fault, it must not be logged as processed. run_bot aborts the pass.
+        raise
+    except Exception:
+        log.exception("Failed to process post %s:%s for domain %s", post_id, post['ap_id'], url_domain)
+        return post_id
+
+    # To reduce low quality submissions, we only process those that made a meaningful summary.
+    if MINIMUM_REDUCTION_THRESHOLD <= summary_dict["reduction"] <= MAXIMUM_REDUCTION_THRESHOLD:
+
+        # We start creating the comment body.
+        post_body = "> " + "\n\n> ".join(summary_dict["top_sentences"])
+
+        top_words = " ".join(f"{word}^#{index + 1}" for index, word in enumerate(summary_dict["top_words"]))
+
+        comment = TEMPLATE.format(
+            article_title, clean_url, summary_dict["reduction"], article_date, post_body)
 
+        # PostUtils.safe_api_call(lemmy.comment.create, post['id'], comment, language_id=LanguageType.EN)
+        log.info("Will add new comment to post %s : %s", post['ap_id'], comment)
+    else:
+        log.info("Skipped:%s, Reduction was %s", post_id, summary_dict['reduction'])
 
-def run_bot(domain, username, password):
-    processed_posts = load_log()
-    blocklist = load_blocklist()
+    return post_id
+
+
+async def run_bot(domain, username, password, processed_posts, conn, summary_cache, pool):
     lemmy = Lemmy(domain)
     PostUtils.safe_api_call(lemmy.log_in, username_or_email=username, password=password)
     posts = PostUtils.get_posts_deep(lemmy, sort=SortType.New, type_=ListingType.Local)
-    logging.info(f"LOADED the latest {len(posts)} posts")
-    for post in posts:
-        post_id = str(post['id'])
-        if 'url' in post and post_id not in processed_posts:
-            clean_url = post['url'].replace("amp.", "")
-            ext = tldextract.extract(clean_url)
-            domain = "{}.{}".format(ext.domain, ext.suffix)
-            if domain in blocklist:
-                logging.debug(f"BLOCKLIST domain: {domain} from {clean_url} on {post['ap_id']}")
-                continue
-
-            logging.info(f"SUMMARIZE domain: {domain} from {clean_url} on {post['ap_id']}")
-
-            try:
-                with requests.get(clean_url, headers=HEADERS, timeout=10) as response:
-                    if response.headers['content-type'] in (
-                            'image/png', 'image/jpeg', 'image/jpg', 'image/gif', 'image/mp4'):
-                        logging.info(f"BLOCK Content-Type: {response.headers['content-type']}")
-                        update_log(post_id)
-                        continue
-
-                    # Most of the times the encoding is utf-8 but in edge cases
-                    # we set it to ISO-8859-1 when it is present in the HTML header.
-                    if "iso-8859-1" in response.text.lower():
-                        response.encoding = "iso-8859-1"
-                    elif response.encoding == "ISO-8859-1":
-                        response.encoding = "utf-8"
-
-                    html_source = response.text
-
-                article_title, article_date, article_body = scraper.scrape_html(html_source)
-
-                summary_dict = summary.get_summary(article_body)
-            except Exception:
-                logging.exception(f"Failed to process post {post_id}:{post['ap_id']} for domain {domain}")
-                update_log(post_id)
-                continue
-
-            # To reduce low quality submissions, we only process those that made a meaningful summary.
-            if MINIMUM_REDUCTION_THRESHOLD <= summary_dict["reduction"] <= MAXIMUM_REDUCTION_THRESHOLD:
-
-                # We start creating the comment body.
-                post_body = "\n\n".join(
-                    ["> " + item for item in summary_dict["top_sentences"]])
-
-                top_words = ""
-
-                for index, word in enumerate(summary_dict["top_words"]):
-                    top_words += "{}^#{} ".format(word, index + 1)
-
-                comment = TEMPLATE.format(
-                    article_title, clean_url, summary_dict["reduction"], article_date, post_body)
-
-                # PostUtils.safe_api_call(lemmy.comment.create, post['id'], comment, language_id=LanguageType.EN)
-                logging.info(f"Will add new comment to post {post['ap_id']} : {comment}")
-                update_log(post_id)
-            else:
-                update_log(post_id)
-                logging.info(f"Skipped:{post_id}, Reduction was {summary_dict['reduction']}")
+    log.info("LOADED the latest %d posts", len(posts))
+
+    # The cheap checks run on all the posts first, only the survivors go through the network.
+    eligible = [post for post in posts if is_eligible(post, processed_posts)]
+    log.info("FILTERED %d posts, %d left to summarize", len(posts) - len(eligible), len(eligible))
+
+    # The default executor is too small on hosts with few cores, we give the downloads
+    # enough threads to reach FETCH_CONCURRENCY. asyncio.run shuts it down after every pass.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY))
+
+    # We fan out the article downloads in chunks so a large backlog doesn't pile up in memory.
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    for start in range(0, len(eligible), FETCH_CHUNK_SIZE):
+        chunk = eligible[start:start + FETCH_CHUNK_SIZE]
+        tasks = [asyncio.create_task(process_post(post, semaphore, summary_cache, pool)) for post in chunk]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for post, result in zip(chunk, results):
+            if isinstance(result, BaseException) and not isinstance(result, BrokenProcessPool):
+                log.error("Unexpected error on post %s:%s", post['id'], post['ap_id'], exc_info=result)
+
+        update_log(conn, [post_id for post_id in results if isinstance(post_id, str)], processed_posts)
+
+        # A dead worker breaks the whole pool, we stop here so init can replace it
+        # instead of letting the remaining posts fail and be logged without a summary.
+        if any(isinstance(result, BrokenProcessPool) for result in results):
+            conn.commit()
+            raise BrokenProcessPool("A summary worker died, aborting this pass")
+
+    conn.commit()
+    expire_summary_cache(summary_cache)
+    summary_cache.sync()
+
+
+def create_pool():
+    """Creates the worker processes that scrape and summarize the articles.
+
+    Workers are spawned rather than forked so they don't inherit our threads and open connections,
+    each one imports the scraper and summary modules (and the NLP model) once.
+
+    Returns
+    -------
+    concurrent.futures.ProcessPoolExecutor
+        The worker pool.
+
+    """
+
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
 
 
 def init():
@@ -168,14 +495,29 @@ def init():
             logging.StreamHandler()
         ]
     )
-    logging.info("Starting Up...")
+    log.info("Starting Up...")
 
     # Don't forget to specify the correct model for your language.
 
-    while True:
-        run_bot(args.domain, args.username, args.password)
-        logging.info(f"Done summarizing posts, will sleep for {args.sleep} seconds...")
-        time.sleep(int(args.sleep))
+    with closing(open_log()) as conn, shelve.open(SUMMARY_CACHE_FILE) as summary_cache:
+        # The log is read only once, run_bot keeps the set up to date as it processes posts.
+        processed_posts = load_log(conn)
+        pool = create_pool()
+
+        try:
+            while True:
+                try:
+                    asyncio.run(run_bot(args.domain, args.username, args.password, processed_posts, conn,
+                                        summary_cache, pool))
+                except BrokenProcessPool:
+                    log.exception("The summary worker pool broke, creating a new one")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = create_pool()
+
+                log.info("Done summarizing posts, will sleep for %s seconds...", args.sleep)
+                time.sleep(int(args.sleep))
+        finally:
+            pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -1,42 +1,107 @@
 import logging
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from pythorhead import Lemmy
 from pythorhead.types import SortType, ListingType
 
+# How many times we call the API before giving up.
+MAX_RETRIES = 10
+
+# Upper bound in seconds for a single backoff delay.
+MAX_RETRY_DELAY = 60
+
+# Default total seconds we are willing to spend retrying a single call.
+RETRY_BUDGET = 600
+
+# Lemmy rate limits API calls per time window, we allow bursts of this many calls
+# and then one call every API_RATE_WINDOW / API_RATE_LIMIT seconds.
+API_RATE_LIMIT = 100
+API_RATE_WINDOW = 600
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """A thread safe token bucket, shared by everything that calls the Lemmy API."""
+
+    def __init__(self, capacity: float, refill: float):
+        self.capacity = capacity
+        self.refill = refill
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, blocking until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.refill
+            time.sleep(wait)
+
+
+API_BUCKET = TokenBucket(capacity=API_RATE_LIMIT, refill=API_RATE_LIMIT / API_RATE_WINDOW)
+
 
 class PostUtils:
 
     @staticmethod
-    def safe_api_call(fun, **kwargs):
-        retries = 1
-        while not (response := fun(**kwargs)) and retries < 10:
+    def safe_api_call(fun, retry_budget: float = RETRY_BUDGET, **kwargs):
+        started = time.monotonic()
+        retries = 0
+        while True:
+            # Retries also take a token from the shared bucket.
+            API_BUCKET.acquire()
+            # pythorhead swallows failed requests and returns None, the status code and
+            # headers of the response never reach us, so every failure is retried alike.
+            if response := fun(**kwargs):
+                return response
+
             retries += 1
-            logging.warning(f"Failed to call {fun.__name__}({kwargs}), will retry again in {retries * 5} seconds")
-            time.sleep(retries * 5)
+            delay = min(MAX_RETRY_DELAY, 2 ** retries + random.uniform(0, 1))
+            if retries >= MAX_RETRIES or time.monotonic() - started + delay > retry_budget:
+                raise RuntimeError("Failed to invoke Lemmy API")
 
-        if retries >= 10:
-            raise RuntimeError("Failed to invoke Lemmy API")
-        else:
-            return response
+            log.warning("Failed to call %s(%s), will retry again in %.1f seconds", fun.__name__, kwargs, delay)
+            time.sleep(delay)
 
     @staticmethod
     def get_posts_deep(lemmy: Lemmy, community_id: Optional[int] = None,
                        community_name: Optional[str] = None,
                        saved_only: Optional[bool] = None,
                        sort: Optional[SortType] = None,
-                       type_: Optional[ListingType] = None):
-        posts = []
-        for i in range(1, 6):
-            response = PostUtils.safe_api_call(lemmy.post.list, community_id=community_id,
-                                               community_name=community_name,
-                                               sort=sort,
-                                               type_=type_, page=i)
+                       type_: Optional[ListingType] = None,
+                       max_workers: int = 5):
+        # The pages don't depend on each other, so we request them at the same time.
+        # max_workers bounds how many requests we have in flight against the instance.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            responses = list(executor.map(
+                lambda i: PostUtils.safe_api_call(lemmy.post.list, community_id=community_id,
+                                                  community_name=community_name,
+                                                  sort=sort,
+                                                  type_=type_, page=i),
+                range(1, 6)))
 
+        posts = []
+        for response in responses:
             # ugly hack since there are very few saved pages....
             if saved_only:
-                posts.extend([post['post'] for post in response if not post['post']["deleted"] and post['saved']])
+                posts.extend([PostUtils.post_fields(post['post']) for post in response
+                              if not post['post']["deleted"] and post['saved']])
             else:
-                posts.extend([post['post'] for post in response if not post['post']["deleted"]])
+                posts.extend([PostUtils.post_fields(post['post']) for post in response if not post['post']["deleted"]])
         return posts
+
+    @staticmethod
+    def post_fields(post: dict) -> dict:
+        # We only keep the fields the bot reads, the full post carries counts, votes, thumbnails...
+        return {"id": post["id"], "url": post.get("url"), "ap_id": post["ap_id"]}